@@ -5,12 +5,21 @@ from torch.optim import Adam
 from model import *
 from torch.utils.tensorboard import SummaryWriter
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from replay_buffer import ReplayBuffer
 import time
 from gym_robotics_custom import RoboGymObservationWrapper
 
+@torch.jit.script
+def target_q(qf1, qf2, logp, reward, mask, alpha: float, gamma: float):
+    return reward + mask * gamma * (torch.minimum(qf1, qf2) - alpha * logp)
+
+@torch.jit.script
+def actor_loss_fn(alpha: float, log_pi, qf1_pi, qf2_pi):
+    return (alpha * log_pi - torch.minimum(qf1_pi, qf2_pi)).mean()
+
 class Agent(object):
-    def __init__(self, n_inputs, action_space, gamma, tau, alpha, target_update_interval, hidden_size, learning_rate, goal):
+    def __init__(self, n_inputs, action_space, gamma, tau, alpha, target_update_interval, hidden_size, learning_rate, goal, allow_tf32=True, compile_networks=True):
         self.alpha = alpha
         self.gamma = gamma
         self.tau = tau
@@ -18,112 +27,170 @@ class Agent(object):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"Initializing device. Running on {self.device}")
 
+        torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+        torch.backends.cudnn.allow_tf32 = allow_tf32
+        torch.backends.cudnn.benchmark = True
+
         self.critic = Critic(n_inputs, action_space.shape[0], hidden_size, name=f"critic_{goal}").to(device=self.device)
-        self.critic_optim = Adam(self.critic.parameters(), lr=learning_rate)
+        self.critic_params = list(self.critic.parameters())
+        self.critic_optim = Adam(self.critic_params, lr=learning_rate)
 
         self.critic_target = Critic(n_inputs, action_space.shape[0], hidden_size, name=f"critic_target_{goal}").to(device=self.device)
         self.hard_update(self.critic_target, self.critic)
         
         self.actor = Actor(n_inputs, action_space.shape[0], hidden_size, action_space, name=f"actor_{goal}").to(device=self.device)
-        self.actor_optim = Adam(self.actor.parameters(), lr=learning_rate)
+        self.actor_params = list(self.actor.parameters())
+        self.actor_optim = Adam(self.actor_params, lr=learning_rate)
+
+        if compile_networks:
+            # the sampling entry points are compiled whole so the tanh squash and log-prob correction fuse with the MLP
+            self.actor.sample = torch.compile(self.actor.sample, dynamic=False)
+            self.actor.act_deterministic = torch.compile(self.actor.act_deterministic, dynamic=False)
+            self.critic.compile(dynamic=False)
+            self.critic_target.compile(dynamic=False)
+
+        self.use_amp = self.device.type == "cuda"
+        self.scaler = torch.amp.GradScaler("cuda", enabled=self.use_amp)
 
+        # persistent staging tensors so select_action does not allocate per env step
+        self._state_host = torch.empty(1, n_inputs, pin_memory=self.device.type == "cuda")
+        self._state_dev = torch.empty(1, n_inputs, device=self.device) if self.device.type == "cuda" else self._state_host
+
+        # alpha is fixed, so its loss is a constant zero kept on the device
+        self._alpha_loss = torch.zeros((), device=self.device)
+
+    @torch.inference_mode()
     def select_action(self, state, evaluate=False):
-        state = torch.FloatTensor(state).to(self.device).unsqueeze(0)
+        self._state_host.copy_(torch.from_numpy(state).unsqueeze(0))
+        if self._state_dev is not self._state_host:
+            self._state_dev.copy_(self._state_host, non_blocking=True)
+        state = self._state_dev
         if evaluate is False:
             action, _, _ = self.actor.sample(state)
         else:
-            _, _, action = self.actor.sample(state)
-        return action.detach().cpu().numpy()[0]
+            action = self.actor.act_deterministic(state)
+        return action.cpu().numpy()[0]
 
     def update_parameters(self, memory : ReplayBuffer, batch_size, updates):
         state_batch, action_batch, reward_batch, next_state_batch, mask_batch = memory.sample_buffer(batch_size=batch_size)
-        state_batch = torch.FloatTensor(state_batch).to(self.device)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.device)
-        action_batch = torch.FloatTensor(action_batch).to(self.device)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.device).unsqueeze(1)
-        mask_batch = torch.FloatTensor(mask_batch).to(self.device).unsqueeze(1)
+        if memory.device != self.device:
+            state_batch, action_batch, reward_batch, next_state_batch, mask_batch = (
+                tensor.to(self.device) for tensor in (state_batch, action_batch, reward_batch, next_state_batch, mask_batch))
+        reward_batch = reward_batch.unsqueeze(1)
+        mask_batch = mask_batch.unsqueeze(1)
 
-        # compute critic loss
-        with torch.no_grad():
-            next_state_action, next_state_log_pi, _ = self.actor.sample(next_state_batch)
-            qf1_next_target, qf2_next_target = self.critic_target(next_state_batch, next_state_action)
-            min_qf_next_target = torch.min(qf1_next_target, qf2_next_target) - self.alpha * next_state_log_pi
-            next_q_value = reward_batch + mask_batch * self.gamma * min_qf_next_target
-
-        qf1, qf2 = self.critic(state_batch, action_batch)
-        qf1_loss = F.mse_loss(qf1, next_q_value)
-        qf2_loss = F.mse_loss(qf2, next_q_value)
-        qf_loss = qf1_loss + qf2_loss
-
-        # update critic network
-        self.critic_optim.zero_grad()
-        qf_loss.backward()
-        self.critic_optim.step()
-
-        # compute actor policy loss
-        pi, log_pi, _ = self.actor.sample(state_batch)
-        qf1_pi, qf2_pi = self.critic(state_batch, pi)
-        min_qf_pi = torch.min(qf1_pi, qf2_pi)
-        actor_loss = ((self.alpha * log_pi) - min_qf_pi).mean()
-
-        # update actor network
-        self.actor_optim.zero_grad()
-        actor_loss.backward()
-        self.actor_optim.step()
-
-        alpha_loss = torch.tensor(0.).to(self.device)
+        qf1_loss, qf2_loss, actor_loss = self._update_step(state_batch, action_batch, reward_batch, next_state_batch, mask_batch)
+
+        alpha_loss = self._alpha_loss
         alpha_tlogs = torch.tensor(self.alpha)
 
         if updates % self.target_update_interval == 0:
             self.soft_update(self.critic_target, self.critic)
 
-        return qf1_loss.item(), qf2_loss.item(), actor_loss.item(), alpha_loss.item(), alpha_tlogs.item()
+        return qf1_loss, qf2_loss, actor_loss, alpha_loss, alpha_tlogs
+
+    def _update_step(self, state_batch, action_batch, reward_batch, next_state_batch, mask_batch):
+        with torch.autocast(device_type=self.device.type, dtype=torch.float16, enabled=self.use_amp):
+            # one actor pass over next_state and state; only the state half is used with gradients
+            actions, log_probs, _ = self.actor.sample(torch.cat([next_state_batch, state_batch], 0))
+            next_state_action, pi = actions.chunk(2)
+            next_state_log_pi, log_pi = log_probs.chunk(2)
+
+            # no_grad rather than inference_mode: next_q_value is saved by mse_loss for backward
+            with torch.no_grad():
+                qf1_next_target, qf2_next_target = self.critic_target(next_state_batch, next_state_action)
+                next_q_value = target_q(qf1_next_target, qf2_next_target, next_state_log_pi, reward_batch, mask_batch, self.alpha, self.gamma)
+
+            # one critic pass over the replayed actions and the policy actions
+            qf1_all, qf2_all = self.critic(torch.cat([state_batch, state_batch], 0), torch.cat([action_batch, pi], 0))
+            qf1, qf1_pi = qf1_all.chunk(2)
+            qf2, qf2_pi = qf2_all.chunk(2)
+
+            # compute critic loss
+            qf1_loss = F.mse_loss(qf1, next_q_value)
+            qf2_loss = F.mse_loss(qf2, next_q_value)
+            qf_loss = qf1_loss + qf2_loss
+
+            # compute actor policy loss
+            actor_loss = actor_loss_fn(self.alpha, log_pi, qf1_pi, qf2_pi)
+
+        # both losses share the critic graph, so each is backpropagated into its own network before either step
+        self.critic_optim.zero_grad(set_to_none=True)
+        self.actor_optim.zero_grad(set_to_none=True)
+        self.scaler.scale(qf_loss).backward(inputs=self.critic_params, retain_graph=True)
+        self.scaler.scale(actor_loss).backward(inputs=self.actor_params)
+
+        # update critic and actor networks
+        self.scaler.step(self.critic_optim)
+        self.scaler.step(self.actor_optim)
+        self.scaler.update()
+
+        return qf1_loss.detach(), qf2_loss.detach(), actor_loss.detach()
 
     def hard_update(self, target, source):
         for target_param, param in zip(target.parameters(), source.parameters()):
             target_param.data.copy_(param.data)
 
     def soft_update(self, target, source):
-        for target_param, param in zip(target.parameters(), source.parameters()):
-            target_param.data.copy_(target_param.data * (1.0 - self.tau) + param.data * self.tau)
+        with torch.no_grad():
+            target_params = [param.data for param in target.parameters()]
+            source_params = [param.data for param in source.parameters()]
+            torch._foreach_mul_(target_params, 1.0 - self.tau)
+            torch._foreach_add_(target_params, source_params, alpha=self.tau)
     
-    def train(self, env, memory, episodes=1000, batch_size=64, updates_per_step=1, summary_writer_name="", max_episode_steps=100):
+    def train(self, env, memory, episodes=1000, batch_size=64, updates_per_step=1, summary_writer_name="", max_episode_steps=100, log_interval=100):
         summary_writer_name = f'runs/{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}_'+summary_writer_name
         writer = SummaryWriter(summary_writer_name)
 
         total_numsteps = 0
         updates = 0
+        pending_logs = []
 
-        for episode in range(episodes):
-            episode_reward = 0
-            episode_steps = 0
-            done = False
-            state, _ = env.reset()
-
-            while not done and episode_steps < max_episode_steps:
-                action = self.select_action(state)
-                if memory.can_sample(batch_size=batch_size):
-                    for i in range(updates_per_step):
-                        critic_1_loss, critic_2_loss, actor_loss, ent_loss, alpha = self.update_parameters(memory, batch_size, updates)
-                        writer.add_scalar('loss/critic_1',critic_1_loss,updates)
-                        writer.add_scalar('loss/critic_2',critic_2_loss,updates)
-                        writer.add_scalar('loss/actor',actor_loss,updates)
-                        writer.add_scalar('loss/entropy_loss',ent_loss,updates)
-                        updates += 1
-
-                next_state, reward, done, _, _ = env.step(action)
-                episode_steps += 1
-                total_numsteps += 1
-                episode_reward += reward
-                mask = 1 if episode_steps == max_episode_steps else float(not done)
-                memory.store_transition(state, action, reward, next_state, mask)
-                state = next_state
-
-            writer.add_scalar('reward/train', episode_reward, episode)
-            print("Episode: {}, Total numsteps: {}, episode steps: {}, reward:{}".format(episode, total_numsteps, episode_steps, round(episode_reward, 2)))
+        with ThreadPoolExecutor(max_workers=1) as env_executor:
+            for episode in range(episodes):
+                episode_reward = 0
+                episode_steps = 0
+                done = False
+                state, _ = env.reset()
 
-            if episode % 10 == 0:
-                self.save_checkpoint()
+                while not done and episode_steps < max_episode_steps:
+                    action = self.select_action(state)
+                    # step the simulator on the worker thread while the networks update
+                    step_future = env_executor.submit(env.step, action)
+                    if memory.can_sample(batch_size=batch_size):
+                        for i in range(updates_per_step):
+                            critic_1_loss, critic_2_loss, actor_loss, ent_loss, alpha = self.update_parameters(memory, batch_size, updates)
+                            pending_logs.append((updates, (critic_1_loss, critic_2_loss, actor_loss, ent_loss)))
+                            updates += 1
+                        if len(pending_logs) >= log_interval:
+                            self.flush_loss_logs(writer, pending_logs)
+
+                    next_state, reward, done, _, _ = step_future.result()
+                    episode_steps += 1
+                    total_numsteps += 1
+                    episode_reward += reward
+                    mask = 1 if episode_steps == max_episode_steps else float(not done)
+                    memory.store_transition(state, action, reward, next_state, mask)
+                    state = next_state
+
+                self.flush_loss_logs(writer, pending_logs)
+                writer.add_scalar('reward/train', episode_reward, episode)
+                print("Episode: {}, Total numsteps: {}, episode steps: {}, reward:{}".format(episode, total_numsteps, episode_steps, round(episode_reward, 2)))
+
+                if episode % 10 == 0:
+                    self.save_checkpoint()
+
+    def flush_loss_logs(self, writer, pending_logs):
+        # a single device-to-host copy for all losses collected since the last flush
+        if not pending_logs:
+            return
+        values = torch.stack([torch.stack(losses) for _, losses in pending_logs]).cpu().tolist()
+        for (step, _), (critic_1_loss, critic_2_loss, actor_loss, ent_loss) in zip(pending_logs, values):
+            writer.add_scalar('loss/critic_1',critic_1_loss,step)
+            writer.add_scalar('loss/critic_2',critic_2_loss,step)
+            writer.add_scalar('loss/actor',actor_loss,step)
+            writer.add_scalar('loss/entropy_loss',ent_loss,step)
+        pending_logs.clear()
 
     def test(self, env : RoboGymObservationWrapper, episodes=1, max_episode_steps=500, prev_action=None):
         for episode in range(episodes):
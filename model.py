@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn. functional as F
 from torch.distributions import Normal
+import math
 import os
 
 LOG_SIG_MAX = 2
@@ -13,6 +14,12 @@ def weights_init_(m):
         torch.nn.init.xavier_uniform_(m.weight, gain=1)
         torch.nn.init.constant_(m.bias, 0)
 
+@torch.jit.script
+def squash_correction(x_t, action_scale, eps: float):
+    # log(scale * (1 - tanh(x)^2)) in the softplus form, which stays finite under fp16
+    log_det = 2. * (math.log(2.) - x_t - F.softplus(-2. * x_t))
+    return log_det.sum(1, keepdim=True) + torch.log(action_scale + eps).sum()
+
 class Actor(nn.Module):
     def __init__(self, n_inputs, n_actions, hidden_dim, action_space=None, checkpoint_dir='checkpoints',name='policy_network'):
         super(Actor, self).__init__()
@@ -29,42 +36,45 @@ class Actor(nn.Module):
 
         self.apply(weights_init_)
 
+        # non-persistent so checkpoints saved before these were buffers still load
         if action_space is None:
-            self.action_scale = torch.tensor(1.)
-            self.action_bias = torch.tensor(0.)
+            self.register_buffer('action_scale', torch.tensor(1.), persistent=False)
+            self.register_buffer('action_bias', torch.tensor(0.), persistent=False)
         else:
-            self.action_scale = torch.FloatTensor(
-                (action_space.high - action_space.low) / 2
-            )
-            self.action_bias = torch.FloatTensor(
-                (action_space.high + action_space.low) / 2
-            )
+            self.register_buffer('action_scale', torch.as_tensor(
+                (action_space.high - action_space.low) / 2, dtype=torch.float32
+            ), persistent=False)
+            self.register_buffer('action_bias', torch.as_tensor(
+                (action_space.high + action_space.low) / 2, dtype=torch.float32
+            ), persistent=False)
+
+    def trunk(self, state):
+        x = F.relu_(self.linear1(state))
+        return F.relu_(self.linear2(x))
 
     def forward(self, state):
-        x = F.relu(self.linear1(state))
-        x = F.relu(self.linear2(x))
+        x = self.trunk(state)
         mean = self.mean_linear(x)
         log_std = self.log_std_linear(x)
         log_std = torch.clamp(log_std, min=LOG_SIG_MIN, max=LOG_SIG_MAX)
         return mean, log_std
 
     def sample(self, state):
-        mean, log_std = self.forward(state)
+        mean, log_std = self(state)
         std = log_std.exp()
-        normal = Normal(mean, std)
+        # validation calls bool() on device tensors, which syncs and breaks CUDA graph capture
+        normal = Normal(mean, std, validate_args=False)
         x_t = normal.rsample()
         y_t = torch.tanh(x_t)
         action = y_t * self.action_scale + self.action_bias
-        log_prob = normal.log_prob(x_t)
-        log_prob -= torch.log(self.action_scale * (1 - y_t.pow(2)) + epsilon)
-        log_prob = log_prob.sum(1, keepdim=True)
+        log_prob = normal.log_prob(x_t).sum(1, keepdim=True)
+        log_prob -= squash_correction(x_t, self.action_scale, epsilon)
         mean = torch.tanh(mean) * self.action_scale + self.action_bias
         return action, log_prob, mean
 
-    def to(self, device):
-        self.action_scale = self.action_scale.to(device)
-        self.action_bias = self.action_bias.to(device)
-        return super(Actor, self).to(device)
+    def act_deterministic(self, state):
+        mean, _ = self(state)
+        return torch.tanh(mean) * self.action_scale + self.action_bias
 
     def save_checkpoint(self):
         torch.save(self.state_dict(), self.checkpoint_file)
@@ -95,12 +105,12 @@ class Critic(nn.Module):
     def forward(self, state, action):
         xu = torch.cat([state, action], 1)
 
-        x1 = F.relu(self.linear1(xu))
-        x1 = F.relu(self.linear2(x1))
+        x1 = F.relu_(self.linear1(xu))
+        x1 = F.relu_(self.linear2(x1))
         x1 = self.output1(x1)
 
-        x2 = F.relu(self.linear3(xu))
-        x2 = F.relu(self.linear4(x2))
+        x2 = F.relu_(self.linear3(xu))
+        x2 = F.relu_(self.linear4(x2))
         x2 = self.output2(x2)
 
         return x1, x2
@@ -1,20 +1,53 @@
 import numpy as np
+import torch
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# the njit version draws from Numba's own generator, which np.random.seed does not reach;
+# seed it by calling np.random.seed from inside an njit function
+def _sample_impl(states, actions, rewards, next_states, dones, size, expert_cutoff, expert_quantity,
+                 out_states, out_actions, out_rewards, out_next_states, out_dones):
+    batch_size = out_states.shape[0]
+    for i in range(batch_size):
+        if i < batch_size - expert_quantity:
+            j = np.random.randint(size)
+        else:
+            j = np.random.randint(expert_cutoff)
+        out_states[i] = states[j]
+        out_actions[i] = actions[j]
+        out_rewards[i] = rewards[j]
+        out_next_states[i] = next_states[j]
+        out_dones[i] = dones[j]
+
+
+if numba is not None:
+    _sample_impl = numba.njit(cache=True)(_sample_impl)
+
 
 class ReplayBuffer():
     def __init__(self, max_size, input_size, n_actions, augment_data=False, augment_rewards=False,
-                 expert_data_ratio=0.1, augment_noise_ratio=0.1):
+                 expert_data_ratio=0.1, augment_noise_ratio=0.1, device=None):
         self.mem_size = max_size
         self.mem_ctr = 0
-        self.state_memory = np.zeros((self.mem_size, input_size))
-        self.next_state_memory = np.zeros((self.mem_size, input_size))
-        self.action_memory = np.zeros((self.mem_size, n_actions))
-        self.reward_memory = np.zeros(self.mem_size)
-        self.terminal_memory = np.zeros(self.mem_size, dtype=bool)
+        # device='cpu' keeps the buffer in host memory and samples it with the numba kernel above
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.state_memory = torch.zeros((self.mem_size, input_size), device=self.device)
+        self.next_state_memory = torch.zeros((self.mem_size, input_size), device=self.device)
+        self.action_memory = torch.zeros((self.mem_size, n_actions), device=self.device)
+        self.reward_memory = torch.zeros(self.mem_size, device=self.device)
+        self.terminal_memory = torch.zeros(self.mem_size, device=self.device)
         self.augment_data = augment_data
         self.augment_rewards = augment_rewards
         self.augment_noise_ratio = augment_noise_ratio
         self.expert_data_ratio = expert_data_ratio
         self.expert_data_cutoff = 0
+        self._sample_out = None
 
     def __len__(self):
         return self.mem_ctr
@@ -28,9 +61,9 @@ class ReplayBuffer():
     def store_transition(self, state, action, reward, next_state, done):
         index = self.mem_ctr % self.mem_size
 
-        self.state_memory[index] = state
-        self.next_state_memory[index] = next_state
-        self.action_memory[index] = action
+        self.state_memory[index].copy_(torch.as_tensor(state))
+        self.next_state_memory[index].copy_(torch.as_tensor(next_state))
+        self.action_memory[index].copy_(torch.as_tensor(action))
         self.reward_memory[index] = reward
         self.terminal_memory[index] = done
 
@@ -39,13 +72,31 @@ class ReplayBuffer():
     def sample_buffer(self, batch_size):
         max_mem = min(self.mem_ctr, self.mem_size)
 
+        if self.device.type == "cpu" and numba is not None:
+            states, actions, rewards, next_states, dones = self._sample_cpu(max_mem, batch_size)
+        else:
+            states, actions, rewards, next_states, dones = self._sample_torch(max_mem, batch_size)
+
+        if self.augment_data:
+            state_noise_std = self.augment_noise_ratio * states.abs().mean()
+            action_noise_std = self.augment_noise_ratio * actions.abs().mean()
+            
+            states.add_(torch.randn_like(states) * state_noise_std)
+            actions.add_(torch.randn_like(actions) * action_noise_std)
+
+        if self.augment_rewards:
+            rewards.mul_(100)
+
+        return states, actions, rewards, next_states, dones
+
+    def _sample_torch(self, max_mem, batch_size):
         if self.expert_data_ratio > 0:
             expert_data_quantity = int(batch_size * self.expert_data_ratio)
-            random_batch = np.random.choice(max_mem, batch_size - expert_data_quantity)
-            expert_batch = np.random.choice(self.expert_data_cutoff, expert_data_quantity)
-            batch = np.concatenate((random_batch, expert_batch))
+            random_batch = torch.randint(max_mem, (batch_size - expert_data_quantity,), device=self.device)
+            expert_batch = torch.randint(self.expert_data_cutoff, (expert_data_quantity,), device=self.device)
+            batch = torch.cat((random_batch, expert_batch))
         else:
-            batch = np.random.choice(max_mem, batch_size)
+            batch = torch.randint(max_mem, (batch_size,), device=self.device)
 
         states = self.state_memory[batch]
         next_states = self.next_state_memory[batch]
@@ -53,26 +104,27 @@ class ReplayBuffer():
         rewards = self.reward_memory[batch]
         dones = self.terminal_memory[batch]
 
-        if self.augment_data:
-            state_noise_std = self.augment_noise_ratio * np.mean(np.abs(states))
-            action_noise_std = self.augment_noise_ratio * np.mean(np.abs(actions))
-            
-            states = states + np.random.normal(0, state_noise_std, states.shape)
-            actions = actions + np.random.normal(0, action_noise_std, actions.shape)
+        return states, actions, rewards, next_states, dones
 
-        if self.augment_rewards:
-            rewards = rewards * 100
+    def _sample_cpu(self, max_mem, batch_size):
+        storage = (self.state_memory, self.action_memory, self.reward_memory, self.next_state_memory, self.terminal_memory)
+        # reused across calls; the update is done with (or has copied) the batch before the next sample
+        if self._sample_out is None or self._sample_out[0].shape[0] != batch_size:
+            self._sample_out = tuple(torch.empty((batch_size,) + tensor.shape[1:]) for tensor in storage)
+        out = self._sample_out
 
-        return states, actions, rewards, next_states, dones
-    
+        expert_data_quantity = int(batch_size * self.expert_data_ratio) if self.expert_data_ratio > 0 else 0
+        _sample_impl(*(tensor.numpy() for tensor in storage), max_mem, self.expert_data_cutoff, expert_data_quantity,
+                     *(tensor.numpy() for tensor in out))
+        return out
     
     def save_to_csv(self, filename):
         np.savez(filename,
-                 state=self.state_memory[:self.mem_ctr],
-                 action=self.action_memory[:self.mem_ctr],
-                 reward=self.reward_memory[:self.mem_ctr],
-                 next_state=self.next_state_memory[:self.mem_ctr],
-                 done=self.terminal_memory[:self.mem_ctr])
+                 state=self.state_memory[:self.mem_ctr].cpu().numpy(),
+                 action=self.action_memory[:self.mem_ctr].cpu().numpy(),
+                 reward=self.reward_memory[:self.mem_ctr].cpu().numpy(),
+                 next_state=self.next_state_memory[:self.mem_ctr].cpu().numpy(),
+                 done=self.terminal_memory[:self.mem_ctr].cpu().numpy())
         print(f"Saved {filename}")
 
     
@@ -80,11 +132,11 @@ class ReplayBuffer():
         try:
             data = np.load(filename)
             self.mem_ctr = len(data['state'])
-            self.state_memory[:self.mem_ctr] = data['state']
-            self.action_memory[:self.mem_ctr] = data['action']
-            self.reward_memory[:self.mem_ctr] = data['reward']
-            self.next_state_memory[:self.mem_ctr] = data['next_state']
-            self.terminal_memory[:self.mem_ctr] = data['done']
+            self.state_memory[:self.mem_ctr] = torch.as_tensor(data['state'])
+            self.action_memory[:self.mem_ctr] = torch.as_tensor(data['action'])
+            self.reward_memory[:self.mem_ctr] = torch.as_tensor(data['reward'])
+            self.next_state_memory[:self.mem_ctr] = torch.as_tensor(data['next_state'])
+            self.terminal_memory[:self.mem_ctr] = torch.as_tensor(data['done'])
             print(f"Successfully loaded {filename} into memory")
             print(f"{self.mem_ctr} memories loaded")
 